@@ -1,7 +1,12 @@
+import argparse
 import sqlite3
 import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import h3
+import json_stream
 from google.maps import routing_v2
 from google.protobuf import field_mask_pb2
 from google.protobuf.json_format import MessageToJson
@@ -13,12 +18,41 @@ load_dotenv()
 DATABASE_NAME = 'hungarian_towns.db'
 NEIGHBORS_FILE = 'county_neighbors.json'
 API_KEY = os.getenv('ROUTES_API_KEY') # Securely load API key
+MAX_MATRIX_ORIGINS = 25 # Origins per computeRouteMatrix request (25 x 25 elements max)
+MAX_API_WORKERS = 16 # Concurrent computeRouteMatrix requests in flight
+UPDATE_BATCH_SIZE = 100 # Town updates written per database transaction
+ROUTE_CACHE_RESOLUTION = 7 # H3 resolution for reusing routes of nearby origins (~5 km² cells)
+MATRIX_ELEMENTS_PER_MINUTE = 3000 # computeRouteMatrix quota (origins x destinations per minute)
+
+_CONN = None # Shared connection, see get_conn()
+_QUOTA_LOCK = threading.Lock() # Guards _next_request_time, see wait_for_matrix_quota()
+_next_request_time = 0.0
 
 # --- DATABASE FUNCTIONS ---
 
-def add_commute_columns():
+def get_conn():
+    """
+    Returns the module's shared database connection, opening it on first use.
+    It runs in autocommit mode with WAL enabled; writers manage their own transactions.
+    """
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(DATABASE_NAME, isolation_level=None)
+        _CONN.execute("PRAGMA journal_mode=WAL")
+        _CONN.execute("PRAGMA synchronous=NORMAL")
+        _CONN.row_factory = sqlite3.Row # Allows accessing columns by name
+    return _CONN
+
+def close_conn():
+    """Closes the shared database connection, if it was opened."""
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
+def add_commute_columns(conn=None):
     """Adds columns to the database to store commute data. Idempotent."""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = conn or get_conn()
     cursor = conn.cursor()
     try:
         cursor.execute("ALTER TABLE towns ADD COLUMN commute_budapest_mins INTEGER")
@@ -30,39 +64,87 @@ def add_commute_columns():
             print("Database columns already exist. Skipping.")
         else:
             raise e
-    conn.commit()
-    conn.close()
 
-def get_all_towns_data():
-    """Fetches all towns with their coordinates and county from the database."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    conn.row_factory = sqlite3.Row # Allows accessing columns by name
+def get_all_towns_data(conn=None):
+    """Fetches all towns with their coordinates, county and any existing Budapest commute from the database."""
+    conn = conn or get_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT name, county, latitude, longitude FROM towns WHERE latitude IS NOT NULL AND longitude IS NOT NULL")
+    cursor.execute("SELECT rowid, name, county, latitude, longitude, commute_budapest_mins FROM towns WHERE latitude IS NOT NULL AND longitude IS NOT NULL")
     towns = cursor.fetchall()
-    conn.close()
     return [dict(row) for row in towns]
 
-def update_town_in_db(town_name, budapest_mins, nearest_capital_mins, nearest_capital_name):
-    """Updates a single town's record with the new commute data."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE towns
-        SET commute_budapest_mins = ?,
-            commute_nearest_capital_mins = ?,
-            nearest_capital_name = ?
-        WHERE name = ?
-    """, (budapest_mins, nearest_capital_mins, nearest_capital_name, town_name))
-    conn.commit()
-    conn.close()
+def update_towns_in_db(updates, conn=None):
+    """
+    Writes a batch of (budapest_mins, nearest_capital_mins, nearest_capital_name, rowid)
+    tuples in a single transaction.
+    """
+    if not updates:
+        return
+    conn = conn or get_conn()
+    conn.execute("BEGIN")
+    try:
+        conn.executemany("""
+            UPDATE towns
+            SET commute_budapest_mins = ?,
+                commute_nearest_capital_mins = ?,
+                nearest_capital_name = ?
+            WHERE rowid = ?
+        """, updates)
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+
+def setup_route_cache(conn=None):
+    """Creates the route_cache table that stores API results per origin cell. Idempotent."""
+    conn = conn or get_conn()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS route_cache (
+            origin_cell TEXT,
+            destinations TEXT,
+            results_json TEXT,
+            PRIMARY KEY (origin_cell, destinations)
+        )
+    """)
+
+def load_route_cache(conn=None):
+    """Returns the cached route results as {(origin_cell, destinations): commute_result}."""
+    conn = conn or get_conn()
+    cursor = conn.execute("SELECT origin_cell, destinations, results_json FROM route_cache")
+    return {(cell, dests): json.loads(results) for cell, dests, results in cursor}
+
+def save_route_cache(entries, conn=None):
+    """Writes a batch of (origin_cell, destinations, results_json) tuples in a single transaction."""
+    if not entries:
+        return
+    conn = conn or get_conn()
+    conn.execute("BEGIN")
+    try:
+        conn.executemany("INSERT OR REPLACE INTO route_cache VALUES (?, ?, ?)", entries)
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
 
 # --- DATA PREPARATION ---
 
 def load_county_neighbors():
-    """Loads the county neighbors and capital names from the JSON file."""
+    """
+    Loads the county neighbors and capital names from the JSON file.
+    The file is streamed, and only the 'capital' and 'neighbors' fields are kept.
+    """
+    county_data = {}
     with open(NEIGHBORS_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+        for county, info in json_stream.load(f).items():
+            county_info = {}
+            # Transient streams can only be read forward, so walk the fields in file order
+            for key, value in info.items():
+                if key == 'capital':
+                    county_info['capital'] = value
+                elif key == 'neighbors':
+                    county_info['neighbors'] = list(value)
+            county_data[county] = county_info
+    return county_data
 
 def get_capital_cities_coords(all_towns, county_data):
     """
@@ -70,29 +152,93 @@ def get_capital_cities_coords(all_towns, county_data):
     by looking them up in the scraped towns data.
     """
     capital_names = {data['capital'] for data in county_data.values()}
-    capital_coords = {}
-    for town in all_towns:
-        if town['name'] in capital_names:
-            capital_coords[town['name']] = {
-                "latitude": town['latitude'],
-                "longitude": town['longitude']
-            }
+    towns_by_name = {town['name']: town for town in all_towns}
+    capital_coords = {
+        name: {
+            "latitude": towns_by_name[name]['latitude'],
+            "longitude": towns_by_name[name]['longitude']
+        }
+        for name in capital_names if name in towns_by_name
+    }
     print(f"Successfully located coordinates for {len(capital_coords)} capital cities in the database.")
     return capital_coords
 
+def normalize_county_name(county):
+    """Strips the suffix from a county name (e.g., "Fejér vármegye" -> "Fejér")."""
+    return county.replace(' vármegye', '')
+
+def build_destinations_by_county(county_data, capital_coords_map):
+    """
+    Builds the destinations (own capital, neighboring capitals and Budapest)
+    for every county once, since they don't depend on the individual town.
+    """
+    dests_by_county = {}
+    for town_county, data in county_data.items():
+        destinations = {}
+        relevant_county_names = [town_county] + data.get('neighbors', [])
+        
+        for county_name in relevant_county_names:
+            capital_name = county_data.get(county_name, {}).get('capital')
+            if capital_name and capital_name in capital_coords_map:
+                destinations[capital_name] = capital_coords_map[capital_name]
+        
+        # Always add Budapest
+        if "Budapest" in capital_coords_map:
+            destinations["Budapest"] = capital_coords_map["Budapest"]
+
+        dests_by_county[town_county] = destinations
+    return dests_by_county
+
+def route_cache_key(town, destinations):
+    """
+    Quantizes the town's location to an H3 cell so that towns only a few km
+    apart share the same cached drive times to the same destinations.
+    """
+    origin_cell = h3.latlng_to_cell(town['latitude'], town['longitude'], ROUTE_CACHE_RESOLUTION)
+    return origin_cell, ",".join(sorted(destinations))
+
 
 # --- GOOGLE ROUTES API FUNCTION ---
 
-def calculate_commute_times(client, origin_coords, destinations):
+def wait_for_matrix_quota(elements):
+    """
+    Token bucket for the elements-per-minute quota, shared by all worker threads.
+    Each request reserves its elements' worth of time, so requests are spaced
+    out evenly and no burst can exceed MATRIX_ELEMENTS_PER_MINUTE.
+    """
+    global _next_request_time
+    with _QUOTA_LOCK:
+        now = time.monotonic()
+        start = max(now, _next_request_time)
+        _next_request_time = start + elements * 60 / MATRIX_ELEMENTS_PER_MINUTE
+    time.sleep(start - now)
+
+def calculate_commute_times(client, origins, destinations):
     """
-    Calls the Google Routes API's computeRouteMatrix to get drive times.
+    Calls the Google Routes API's computeRouteMatrix to get drive times from
+    every origin to every destination in a single request.
+    Returns a dict of {origin_name: {"budapest_mins", "nearest_capital_mins",
+    "nearest_capital_name", "all_routes_found"}}.
     """
-    if not destinations:
-        return {}
+    origin_names = list(origins.keys())
+    destination_names = list(destinations.keys())
+    results = {
+        name: {
+            "budapest_mins": None,
+            "nearest_capital_mins": None,
+            "nearest_capital_name": None,
+            "all_routes_found": True,
+        }
+        for name in origin_names
+    }
+    if not origins or not destinations:
+        return results
     
-    route_origins = [routing_v2.RouteMatrixOrigin(
-        waypoint=routing_v2.Waypoint(location=routing_v2.Location(lat_lng=origin_coords))
-    )]
+    route_origins = [
+        routing_v2.RouteMatrixOrigin(
+            waypoint=routing_v2.Waypoint(location=routing_v2.Location(lat_lng=origin_coords))
+        ) for origin_coords in origins.values()
+    ]
     route_destinations = [
         routing_v2.RouteMatrixDestination(
             waypoint=routing_v2.Waypoint(location=routing_v2.Location(lat_lng=dest_coords))
@@ -108,6 +254,7 @@ def calculate_commute_times(client, origin_coords, destinations):
     # Create the FieldMask object to hold our desired paths
     field_mask = field_mask_pb2.FieldMask(paths=["origin_index", "destination_index", "duration", "status"])
 
+    wait_for_matrix_quota(len(route_origins) * len(route_destinations))
     try:
         # *** THE FINAL FIX ***
         # Manually join the paths into a simple comma-separated string.
@@ -116,28 +263,53 @@ def calculate_commute_times(client, origin_coords, destinations):
             request=request,
             metadata=[("x-goog-fieldmask", ",".join(field_mask.paths))],
         )
+
+        # Reduce each element to Budapest / nearest capital as it streams in,
+        # instead of collecting every destination's time first.
+        # Stream errors are raised here, during iteration, not by the call above.
+        for element in response_stream:
+            origin_name = origin_names[element.origin_index]
+            dest_name = destination_names[element.destination_index]
+            result = results[origin_name]
+            if element.status.code != 0:
+                print(f"  WARNING: Could not find route from {origin_name} to {dest_name}. Status: {element.status.message} (Code: {element.status.code})")
+                result["all_routes_found"] = False
+                continue
+
+            commute_mins = round(element.duration.seconds / 60)
+            if dest_name == "Budapest":
+                result["budapest_mins"] = commute_mins
+            elif result["nearest_capital_mins"] is None or commute_mins < result["nearest_capital_mins"]:
+                result["nearest_capital_mins"] = commute_mins
+                result["nearest_capital_name"] = dest_name
     except Exception as e:
         print(f"  ERROR: API call failed: {e}")
         return None
-
-    results = {}
-    destination_names = list(destinations.keys())
-    for element in response_stream:
-        if element.status.code == 0:
-            duration_seconds = element.duration.seconds
-            commute_mins = round(duration_seconds / 60)
-            dest_name = destination_names[element.destination_index]
-            results[dest_name] = commute_mins
-        else:
-            dest_name = destination_names[element.destination_index]
-            print(f"  WARNING: Could not find route to {dest_name}. Status: {element.status.message} (Code: {element.status.code})")
-            results[dest_name] = None
     return results
 
 
+def build_town_update(town, commute_result):
+    """Turns a town's result from calculate_commute_times into the row for update_towns_in_db."""
+    budapest_mins = commute_result["budapest_mins"]
+    nearest_capital_mins = commute_result["nearest_capital_mins"]
+    nearest_capital_name = commute_result["nearest_capital_name"]
+
+    if nearest_capital_name is not None:
+        print(f"  -> {town['name']}: Budapest: {budapest_mins} min. Nearest capital: {nearest_capital_name} ({nearest_capital_mins} min).")
+    else:
+        # Still update with Budapest time if available
+        print(f"  -> Could not determine nearest capital for {town['name']}.")
+    return (budapest_mins, nearest_capital_mins, nearest_capital_name, town['rowid'])
+
+
 # --- MAIN EXECUTION ---
 
 def main():
+    parser = argparse.ArgumentParser(description="Enrich towns with drive times to Budapest and the nearest county capital.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Only process towns that don't have a Budapest commute time yet.")
+    args = parser.parse_args()
+
     if not API_KEY:
         print("ERROR: GOOGLE_API_KEY environment variable not set. Exiting.")
         return
@@ -151,68 +323,123 @@ def main():
     add_commute_columns()
     county_data = load_county_neighbors()
     all_towns = get_all_towns_data()
+    # Capitals are looked up among all towns, even if they were processed already
     capital_coords_map = get_capital_cities_coords(all_towns, county_data)
+    dests_by_county = build_destinations_by_county(county_data, capital_coords_map)
 
     print("\nStarting commute time enrichment process...")
-    total_towns = len(all_towns)
+    if args.resume:
+        towns_to_process = [town for town in all_towns if town['commute_budapest_mins'] is None]
+        print(f"Resuming: {len(all_towns) - len(towns_to_process)} towns already have commute data.")
+    else:
+        towns_to_process = all_towns
 
-    # 2. Loop through each town and process
-    for i, town in enumerate(all_towns[1000:1500]):
-        print(f"({i+1}/{total_towns}) Processing: {town['name']}...")
-        
-        # Normalize county name (e.g., "Fejér vármegye" -> "Fejér")
-        town_county = town['county'].replace(' vármegye', '')
-        if town_county not in county_data:
-            print(f"  WARNING: County '{town['county']}' not found in relationships JSON. Skipping.")
-            continue
+    # Visit towns that share the same destination list next to each other,
+    # so their batches and cache lookups are issued back to back
+    towns_to_process = sorted(towns_to_process, key=lambda town: (
+        tuple(sorted(dests_by_county.get(normalize_county_name(town['county']), {}))),
+        town['county'],
+        town['name'],
+    ))
 
-        # 3. Build the list of destinations for this specific town
-        destinations_to_check = {}
-        relevant_county_names = [town_county] + county_data[town_county].get('neighbors', [])
-        
-        for county_name in relevant_county_names:
-            capital_name = county_data.get(county_name, {}).get('capital')
-            if capital_name and capital_name in capital_coords_map:
-                destinations_to_check[capital_name] = capital_coords_map[capital_name]
-        
-        # Always add Budapest
-        if "Budapest" in capital_coords_map:
-            destinations_to_check["Budapest"] = capital_coords_map["Budapest"]
+    setup_route_cache()
+    route_cache = load_route_cache()
+    pending_updates = []
+    pending_cache_entries = []
 
-        # 4. Make the API call
-        origin_coords = {"latitude": town['latitude'], "longitude": town['longitude']}
-        commute_results = calculate_commute_times(routes_client, origin_coords, destinations_to_check)
-        
-        if commute_results is None:
-            print(f"  Skipping database update for {town['name']} due to API error.")
+    # 2. Group towns by the set of destinations they need, so each group
+    #    can share one route matrix request. Towns in an already cached cell
+    #    are answered from the cache, and only the first town of each
+    #    uncached cell is sent to the API on behalf of the others.
+    buckets = {}
+    towns_by_cache_key = {}
+    for town in towns_to_process:
+        town_county = normalize_county_name(town['county'])
+        if town_county not in dests_by_county:
+            print(f"  WARNING: County '{town['county']}' not found in relationships JSON. Skipping {town['name']}.")
             continue
 
-        # 5. Process results and update the database
-        budapest_mins = commute_results.get("Budapest")
-        
-        capital_commutes = {
-            name: mins for name, mins in commute_results.items() 
-            if name != "Budapest" and mins is not None
-        }
+        destinations_to_check = dests_by_county[town_county]
+        cache_key = route_cache_key(town, destinations_to_check)
+        if cache_key in route_cache:
+            pending_updates.append(build_town_update(town, route_cache[cache_key]))
+            continue
+        if cache_key in towns_by_cache_key:
+            towns_by_cache_key[cache_key].append(town)
+            continue
+        towns_by_cache_key[cache_key] = [town]
 
-        if capital_commutes:
-            nearest_capital_name = min(capital_commutes, key=capital_commutes.get)
-            nearest_capital_mins = capital_commutes[nearest_capital_name]
-            
-            update_town_in_db(
-                town['name'],
-                budapest_mins,
-                nearest_capital_mins,
-                nearest_capital_name
-            )
-            print(f"  -> Budapest: {budapest_mins} min. Nearest capital: {nearest_capital_name} ({nearest_capital_mins} min). DB updated.")
-        else:
-            print(f"  -> Could not determine nearest capital for {town['name']}.")
-            # Still update with Budapest time if available
-            update_town_in_db(town['name'], budapest_mins, None, None)
+        bucket_key = frozenset(destinations_to_check)
+        buckets.setdefault(bucket_key, (destinations_to_check, []))[1].append(town)
+
+    print(f"Answered {len(pending_updates)} towns from the route cache.")
+    # Progress counts every town an API result is written to, including
+    # the other towns in the same cached cell
+    total_towns = sum(len(cell_towns) for cell_towns in towns_by_cache_key.values())
+
+    # 3. Split every group into chunks of up to MAX_MATRIX_ORIGINS towns
+    work_items = []
+    for destinations_to_check, towns in buckets.values():
+        for start in range(0, len(towns), MAX_MATRIX_ORIGINS):
+            work_items.append((towns[start:start + MAX_MATRIX_ORIGINS], destinations_to_check))
+
+    # 4. Run the API calls concurrently; results are written to the database
+    #    from this thread only, so SQLite never sees concurrent writers
+    processed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_API_WORKERS) as executor:
+            try:
+                futures = {}
+                for batch, destinations_to_check in work_items:
+                    origins = {
+                        town['name']: {"latitude": town['latitude'], "longitude": town['longitude']}
+                        for town in batch
+                    }
+                    future = executor.submit(calculate_commute_times, routes_client, origins, destinations_to_check)
+                    futures[future] = (batch, destinations_to_check)
+
+                for future in as_completed(futures):
+                    batch, destinations_to_check = futures[future]
+                    batch_towns = sum(
+                        len(towns_by_cache_key[route_cache_key(town, destinations_to_check)]) for town in batch
+                    )
+                    processed += batch_towns
+                    print(f"({processed}/{total_towns}) Received results for {batch_towns} towns.")
+
+                    # A failing batch only costs its own towns; the others keep going
+                    try:
+                        batch_results = future.result()
+                    except Exception as e:
+                        print(f"  ERROR: Batch failed: {e}")
+                        batch_results = None
+                    if batch_results is None:
+                        print(f"  Skipping database update for {batch_towns} towns due to API error.")
+                        continue
+
+                    for town in batch:
+                        commute_result = batch_results[town['name']]
+                        cache_key = route_cache_key(town, destinations_to_check)
+                        for cell_town in towns_by_cache_key[cache_key]:
+                            pending_updates.append(build_town_update(cell_town, commute_result))
+                        # Failed routes are not cached so that they are retried on the next run
+                        if commute_result["all_routes_found"] and commute_result["budapest_mins"] is not None:
+                            pending_cache_entries.append((*cache_key, json.dumps(commute_result, ensure_ascii=False)))
 
-        # A small delay to respect API rate limits and avoid overwhelming the service
-        time.sleep(0.05) 
+                    if len(pending_updates) >= UPDATE_BATCH_SIZE:
+                        update_towns_in_db(pending_updates)
+                        save_route_cache(pending_cache_entries)
+                        print(f"  Saved {len(pending_updates)} towns to the database.")
+                        pending_updates = []
+                        pending_cache_entries = []
+            except BaseException:
+                # Don't make (and pay for) the queued API calls when the run is aborting
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        # Keep whatever was received, even if the run stopped early
+        update_towns_in_db(pending_updates)
+        save_route_cache(pending_cache_entries)
+        close_conn()
 
     print("\nEnrichment process complete!")
 
@@ -1,32 +1,26 @@
 import sqlite3
 import sys
+import numpy as np
 
 DATABASE_NAME = 'hungarian_towns.db'
 
-def correct_coordinate(coord):
+def correct_coordinates(coords):
     """
-    Applies the heuristic: if a coordinate is a large number,
-    it converts it from (e.g.) 47123456.0 to 47.123456.
+    Applies the heuristic to a NumPy array of coordinates: if a coordinate is a
+    large number, it is scaled down so that two digits remain before the
+    decimal point, e.g. 47123456.0 -> 47.123456.
     """
-    # If the coordinate is None or already looks valid, don't touch it.
-    if coord is None or (abs(coord) < 180):
-        return coord
+    magnitude = np.abs(coords)
+    # NaN (NULL in the database) and already valid values are left untouched
+    needs_fix = magnitude >= 180
 
-    try:
-        # Convert the large float to an integer string to remove the trailing '.0'
-        coord_str = str(int(coord))
-
-        # Re-insert the decimal point after the first two digits
-        if len(coord_str) > 2:
-            corrected_str = coord_str[:2] + '.' + coord_str[2:]
-            return float(corrected_str)
-        else:
-            # This case shouldn't happen, but as a safeguard:
-            return float(coord)
+    # Power of ten that moves the decimal point to right after the first two digits
+    shift = np.floor(np.log10(np.where(needs_fix, magnitude, 1.0))) - 1
+    return np.where(needs_fix, coords / 10.0 ** shift, coords)
 
-    except (ValueError, TypeError):
-        # If any conversion fails, return the original value
-        return coord
+def to_db_values(coords):
+    """Converts a coordinate array back to Python floats, with NaN mapped to None (NULL)."""
+    return np.where(np.isnan(coords), None, coords).tolist()
 
 def main():
     """
@@ -39,7 +33,7 @@ def main():
         cursor = conn.cursor()
 
         # Fetch all rows with potentially broken coordinates
-        cursor.execute("SELECT name, latitude, longitude FROM towns WHERE latitude > 180 OR longitude > 180")
+        cursor.execute("SELECT rowid, latitude, longitude FROM towns WHERE latitude > 180 OR longitude > 180")
         rows_to_fix = cursor.fetchall()
 
         if not rows_to_fix:
@@ -49,14 +43,13 @@ def main():
 
         print(f"Found {len(rows_to_fix)} rows with invalid coordinates. Starting correction process...")
 
-        updates = []
-        for name, lat, lon in rows_to_fix:
-            corrected_lat = correct_coordinate(lat)
-            corrected_lon = correct_coordinate(lon)
-            updates.append((corrected_lat, corrected_lon, name))
+        rowids, lats, lons = zip(*rows_to_fix)
+        corrected_lats = correct_coordinates(np.array(lats, dtype=float))
+        corrected_lons = correct_coordinates(np.array(lons, dtype=float))
+        updates = list(zip(to_db_values(corrected_lats), to_db_values(corrected_lons), rowids))
 
         # Use executemany for an efficient batch update
-        cursor.executemany("UPDATE towns SET latitude = ?, longitude = ? WHERE name = ?", updates)
+        cursor.executemany("UPDATE towns SET latitude = ?, longitude = ? WHERE rowid = ?", updates)
 
         conn.commit()
         print(f"Successfully corrected and updated {cursor.rowcount} rows in the database.")
@@ -1,5 +1,7 @@
+import os
 import sqlite3
-import pandas as pd
+import numpy as np
+from python_calamine import CalamineWorkbook
 
 DATABASE_NAME = 'hungarian_towns.db'
 EXCEL_FILE_PATH = 'átlagkereset.xlsx' # Make sure this matches your file name
@@ -25,62 +27,63 @@ def setup_income_table():
 def process_and_insert_income_data():
     """Reads the Excel file, transforms the data, and inserts it into the database."""
     try:
-        # 1. Read the Excel file into a pandas DataFrame
-        df = pd.read_excel(EXCEL_FILE_PATH, engine='calamine')
-        print(f"Successfully loaded {EXCEL_FILE_PATH} with {len(df)} rows.")
+        # Calamine reports a missing file as a plain OSError, so check for it up front
+        if not os.path.exists(EXCEL_FILE_PATH):
+            raise FileNotFoundError(EXCEL_FILE_PATH)
 
-        # 2. Transform the data from wide to long format
-        # id_vars are the columns we want to keep as identifiers
-        # value_vars are the columns that will be "unpivoted"
-        id_vars = ['Name', 'Type']
-        value_vars = [col for col in df.columns if 'Q' in str(col)]
+        # 1. Read the first sheet of the Excel file as rows of cell values
+        workbook = CalamineWorkbook.from_path(EXCEL_FILE_PATH)
+        rows = workbook.get_sheet_by_index(0).to_python()
+        header, data = rows[0], np.array(rows[1:], dtype=object)
+        print(f"Successfully loaded {EXCEL_FILE_PATH} with {len(data)} rows.")
 
-        df_long = pd.melt(df, id_vars=id_vars, value_vars=value_vars,
-                          var_name='period', value_name='average_income')
+        # 2. Transform the data from wide to long format with NumPy
+        # The 'Name' column identifies the county, the quarter columns
+        # (e.g., '21Q1') are "unpivoted" into one record per county and quarter
+        name_col = header.index('Name')
+        quarter_cols = [i for i, col in enumerate(header) if 'Q' in str(col)]
+        periods = np.array([str(header[i]) for i in quarter_cols])
 
-        # 3. Clean and prepare the data for insertion
-        # Remove any rows where income is not a number
-        df_long.dropna(subset=['average_income'], inplace=True)
-        
-        # Split 'period' (e.g., '21Q1') into 'year' and 'quarter'
-        df_long['year'] = '20' + df_long['period'].astype(str).str[:2]
-        df_long['quarter'] = df_long['period'].astype(str).str[3]
+        county_names = np.repeat(data[:, name_col], len(quarter_cols))
+        incomes = data[:, quarter_cols].reshape(-1).astype(str)
 
-        # Convert columns to the correct data types
-        df_long['year'] = df_long['year'].astype(int)
-        df_long['quarter'] = df_long['quarter'].astype(int)
-        
+        # Split 'period' (e.g., '21Q1') into 'year' and 'quarter' with integer
+        # arithmetic: '21Q1' -> 211 -> year 2000 + 21, quarter 1
+        period_codes = np.char.replace(periods, 'Q', '').astype(np.int16)
+        years = np.tile(2000 + period_codes // 10, len(data))
+        quarters = np.tile(period_codes % 10, len(data))
+
+        # 3. Clean and prepare the data for insertion
         # Handle potential spaces in numbers (e.g., '396 509')
-        if df_long['average_income'].dtype == 'object':
-            df_long['average_income'] = df_long['average_income'].astype(str).str.replace(' ', '').astype(int)
-        else:
-            df_long['average_income'] = df_long['average_income'].astype(int)
+        incomes = np.char.replace(incomes, ' ', '')
 
-        # Rename 'Name' to 'county_name' to match our database schema
-        df_long.rename(columns={'Name': 'county_name'}, inplace=True)
-        
-        # Select only the columns we need for the database
-        df_to_insert = df_long[['county_name', 'year', 'quarter', 'average_income']]
+        # Remove any records where the income cell is empty
+        has_income = incomes != ''
+        records = list(zip(
+            county_names[has_income].tolist(),
+            years[has_income].tolist(),
+            quarters[has_income].tolist(),
+            incomes[has_income].astype(float).astype(np.int32).tolist(),
+        ))
         
-        print(f"Data transformed. Ready to insert {len(df_to_insert)} records.")
+        print(f"Data transformed. Ready to insert {len(records)} records.")
 
         # 4. Insert data into the SQLite table
         conn = sqlite3.connect(DATABASE_NAME)
         cursor = conn.cursor()
 
-        insert_count = 0
-        for index, row in df_to_insert.iterrows():
-            try:
-                cursor.execute('''
+        try:
+            with conn:  # One transaction for the whole load
+                cursor.executemany('''
                     INSERT OR REPLACE INTO county_income (county_name, year, quarter, average_income)
                     VALUES (?, ?, ?, ?)
-                ''', (row['county_name'], row['year'], row['quarter'], row['average_income']))
-                insert_count += 1
-            except sqlite3.Error as e:
-                print(f"Error inserting row {index}: {e}")
-
-        conn.commit()
-        conn.close()
+                ''', records)
+            insert_count = len(records)
+        except sqlite3.Error as e:
+            print(f"Error inserting records, no changes were saved: {e}")
+            insert_count = 0
+        finally:
+            conn.close()
         
         print(f"Successfully inserted/updated {insert_count} records into the `county_income` table.")
 
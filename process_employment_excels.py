@@ -2,16 +2,33 @@ import pandas as pd
 import os
 import re
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 
 # --- CONFIGURATION ---
 INPUT_DATA_DIR = "employment_excels"
 DATABASE_NAME = 'hungarian_towns.db'
 TABLE_NAME = 'unemployment_stats'
+# SQLite settings for bulk loading (WAL, 64 MiB cache, 256 MiB mmap)
+SQLITE_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+"""
+JUNK_ROW_PATTERN = re.compile(r'vármegye|főváros|\*', re.IGNORECASE) # County/capital subtotals and footnotes
+FILENAME_DATE_PATTERN = re.compile(r'(20\d{2})(\d{2})') # YYYYMM in e.g. T01202411.xlsx
 
 # --- DATABASE SETUP ---
+def connect_db():
+    """Opens a connection to the database with pragmas tuned for bulk writes."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    conn.executescript(SQLITE_PRAGMAS)
+    return conn
+
 def setup_database():
     """Sets up the SQLite database and the unemployment stats table."""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
@@ -35,7 +52,7 @@ def get_date_from_filename(filename):
     Extracts YYYY-MM-01 date string from filename formats like T...202411.xlsx
     """
     # CORRECTED REGEX: Specifically looks for a 20XX year followed by a two-digit month.
-    match = re.search(r'(20\d{2})(\d{2})', filename)
+    match = FILENAME_DATE_PATTERN.search(filename)
     if match:
         year, month = match.groups()
         # Additional check for valid month
@@ -57,7 +74,7 @@ def process_excel_file(filepath):
     print(f"Processing {filename} for date {date_str}...")
 
     try:
-        all_sheets = pd.read_excel(filepath, sheet_name=None, skiprows=7, header=None, engine='openpyxl')
+        all_sheets = pd.read_excel(filepath, sheet_name=None, skiprows=7, header=None, engine='calamine')
     except Exception as e:
         print(f"  -> Could not read Excel file: {e}")
         return None
@@ -75,16 +92,20 @@ def process_excel_file(filepath):
             continue
 
         df.columns = column_headers
-        df = df.drop(columns=['empty_b', 'empty_c'])
         df = df.dropna(subset=['town_name'])
-        df = df[~df['town_name'].astype(str).str.contains("vármegye|főváros|\\*", case=False, na=False)]
+        junk_rows = df['town_name'].astype(str).str.contains(JUNK_ROW_PATTERN, na=False)
+        df = df.loc[~junk_rows, ['town_name', 'unemployed_total', 'working_age_population', 'unemployment_rate', 'relative_ratio']]
         
         df['town_name'] = df['town_name'].astype(str).str.strip().str.upper()
         
         numeric_cols = ['unemployed_total', 'working_age_population', 'unemployment_rate', 'relative_ratio']
-        for col in numeric_cols:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '.'), errors='coerce')
+        numeric_df = df[numeric_cols]
+        # Only text cells can hold decimal commas (e.g. '4,35'), so skip the
+        # string pass entirely when the sheet was read as numbers. Text columns
+        # are 'object' or, on pandas 3, 'str', so check for non-numeric instead.
+        if not all(map(pd.api.types.is_numeric_dtype, numeric_df.dtypes)):
+            numeric_df = numeric_df.replace({',': '.'}, regex=True)
+        df[numeric_cols] = numeric_df.apply(pd.to_numeric, errors='coerce')
 
         df = df.dropna(subset=numeric_cols)
         all_clean_data.append(df)
@@ -102,27 +123,29 @@ def process_excel_file(filepath):
     print(f"  -> Successfully processed {len(monthly_df)} rows.")
     return monthly_df
 
-def save_to_db(df):
+def save_to_db(monthly_dfs):
     """
-    Saves the monthly DataFrame to SQLite using a universally compatible
-    DELETE-then-INSERT approach to prevent duplicates.
+    Saves all monthly DataFrames to SQLite in a single transaction, using a
+    universally compatible DELETE-then-INSERT approach to prevent duplicates.
     """
-    if df is None or df.empty: return
-
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    date_str = df['date'].iloc[0]
-
-    # 1. DELETE any existing records for this specific month.
-    # This makes the script safely re-runnable without creating duplicates.
-    cursor.execute(f"DELETE FROM {TABLE_NAME} WHERE date = ?", (date_str,))
-    
-    # 2. INSERT the new, clean data for the month.
-    df.to_sql(TABLE_NAME, conn, if_exists='append', index=False)
-    
-    print(f"Saved {len(df)} records for {date_str} to the database after clearing previous entries.")
-    conn.commit()
+    monthly_dfs = [df for df in monthly_dfs if df is not None and not df.empty]
+    if not monthly_dfs: return
+
+    all_months_df = pd.concat(monthly_dfs, ignore_index=True)
+    dates = sorted(all_months_df['date'].unique())
+
+    conn = connect_db()
+    with conn:
+        # 1. DELETE any existing records for these months.
+        # This makes the script safely re-runnable without creating duplicates.
+        placeholders = ", ".join("?" for _ in dates)
+        conn.execute(f"DELETE FROM {TABLE_NAME} WHERE date IN ({placeholders})", dates)
+        
+        # 2. INSERT the new, clean data for all months.
+        all_months_df.to_sql(TABLE_NAME, conn, if_exists='append', index=False, method='multi', chunksize=1000)
     conn.close()
+    
+    print(f"Saved {len(all_months_df)} records for {len(dates)} months to the database after clearing previous entries.")
 
 # --- MAIN EXECUTION ---
 def main():
@@ -141,11 +164,14 @@ def main():
         
     print(f"\nFound {len(excel_files)} Excel files to process in '{INPUT_DATA_DIR}'.\n")
     
-    for filename in sorted(excel_files):
-        filepath = os.path.join(INPUT_DATA_DIR, filename)
-        monthly_dataframe = process_excel_file(filepath)
-        if monthly_dataframe is not None and not monthly_dataframe.empty:
-            save_to_db(monthly_dataframe)
+    filepaths = [os.path.join(INPUT_DATA_DIR, filename) for filename in sorted(excel_files)]
+
+    # Parse the files in parallel worker processes; saving stays in this
+    # process so SQLite only ever has a single writer.
+    with ProcessPoolExecutor() as executor:
+        monthly_dataframes = list(executor.map(process_excel_file, filepaths))
+
+    save_to_db(monthly_dataframes)
 
     print("\nUnemployment data processing from local files is complete!")
 
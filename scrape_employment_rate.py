@@ -1,9 +1,14 @@
 import hrequests
-from bs4 import BeautifulSoup
+import numpy as np
 import pandas as pd
+from python_calamine import CalamineWorkbook
+import email.utils
 import os
 import re
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from tenacity import retry, retry_if_exception_type, retry_if_result, stop_after_attempt, wait_exponential
 
 BASE_URL = "https://nfsz.munka.hu"
 # *** THIS IS THE CORRECTED URL ***
@@ -13,13 +18,63 @@ VISIBLE_PAGE_URL = f"{BASE_URL}/tart/stat_telepulessoros_adatok"
 DOWNLOAD_DIR = "unemployment_data"
 DATABASE_NAME = 'hungarian_towns.db'
 TABLE_NAME = 'unemployment_stats'
+DOWNLOAD_WORKERS = 8 # Files downloaded concurrently
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+HTTP_RETRY_ATTEMPTS = 5 # Tries per request before giving up
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504} # Responses worth retrying
+# Write-friendly settings for the bulk inserts, applied on every connect
+SQLITE_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+"""
+XLSX_LINK_PATTERN = re.compile(r'.*?(\d{4}).*\.xlsx') # First four-digit year in an Excel file path
+FILENAME_DATE_PATTERN = re.compile(r'T01(\d{4})(\d{2})\.xlsx') # e.g. T01202411.xlsx
+
+# --- HTTP ---
+
+# Transient failures (connection resets, 429/5xx) are retried with exponential backoff.
+# When the attempts run out, the final response comes back (or its error is raised),
+# and the caller deals with it the same way as before.
+http_retry = retry(
+    stop=stop_after_attempt(HTTP_RETRY_ATTEMPTS),
+    wait=wait_exponential(multiplier=0.5),
+    retry=retry_if_exception_type(hrequests.exceptions.ClientException)
+    | retry_if_result(lambda response: response.status_code in RETRY_STATUS_CODES),
+    retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+)
+
+http_get = http_retry(hrequests.get)
+http_post = http_retry(hrequests.post)
 
 # --- DATABASE SETUP ---
 
+_CONN = None # Shared connection, see get_conn()
+
+def get_conn():
+    """
+    Returns the script's long-lived database connection, opening it with the
+    tuned pragmas on first use. It runs in autocommit mode, so writers wrap
+    their work in explicit BEGIN/COMMIT.
+    """
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(DATABASE_NAME, isolation_level=None, check_same_thread=False)
+        _CONN.executescript(SQLITE_PRAGMAS)
+    return _CONN
+
+def close_conn():
+    """Closes the shared database connection, if it was opened."""
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
 def setup_database():
     """Sets up the SQLite database and the unemployment stats table."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    cursor = get_conn().cursor()
     cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
             town_name TEXT,
@@ -30,8 +85,6 @@ def setup_database():
             PRIMARY KEY (town_name, date)
         )
     ''')
-    conn.commit()
-    conn.close()
     print(f"Database '{DATABASE_NAME}' and table '{TABLE_NAME}' are ready.")
 
 # --- STEP 1: FIND & DOWNLOAD EXCEL FILES ---
@@ -59,7 +112,7 @@ def get_excel_links():
     try:
         # Step 1 & 2: Visit the page and capture the cookies
         print(f"  -> GET {VISIBLE_PAGE_URL} to obtain session cookies...")
-        get_response = hrequests.get(VISIBLE_PAGE_URL, headers=headers)
+        get_response = http_get(VISIBLE_PAGE_URL, headers=headers)
         if get_response.status_code != 200:
             print(f"Failed to fetch {API_ENDPOINT_URL}. Status code: {get_response.status_code}")
             return None
@@ -68,7 +121,7 @@ def get_excel_links():
 
         # Step 3: Make the API call, explicitly passing the captured cookies
         print(f"  -> POST {API_ENDPOINT_URL} with captured cookies...")
-        post_response = hrequests.post(
+        post_response = http_post(
             API_ENDPOINT_URL,
             data=payload,
             headers=headers,
@@ -85,58 +138,142 @@ def get_excel_links():
         return []
 
     links = []
+    seen = set()
     for item in data:
         # The key for the file path is 'DOC_URL_PUB'
         href = item.get('DOC_URL_PUB', '')
-        
-        # We only want Excel files, not PDFs
-        if '.xlsx' not in href:
+
+        # Skip files already collected before doing any further work on them
+        if href in seen:
             continue
+        seen.add(href)
 
-        # Use regex to find the year and filter for 2023 onwards
-        match = re.search(r'(\d{4})', href)
-        if match:
-            year = int(match.group(1))
-            if year >= 2023:
-                full_url = BASE_URL + href
-                links.append(full_url)
+        # One match checks for an Excel file (not a PDF) and captures its year,
+        # which is filtered for 2023 onwards
+        match = XLSX_LINK_PATTERN.match(href)
+        if match and int(match.group(1)) >= 2023:
+            links.append(BASE_URL + href)
 
     if not links:
         print("WARNING: No Excel links were found. The website's API may have changed.")
     else:
         print(f"Found {len(links)} relevant Excel files (2023-present) via API.")
         
-    return list(set(links))
+    return links
+
+def get_range_validator(response):
+    """
+    Returns the response's strong ETag, or else its Last-Modified date, for use in
+    an If-Range header. Weak ETags ('W/...') are not allowed there, so they are skipped.
+    """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+def remove_partial_download(part_path):
+    """Deletes a '.part' file and its saved validator, if they exist."""
+    for path in (part_path, part_path + '.validator'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def download_file(session, link):
+    """
+    Downloads a single file into DOWNLOAD_DIR and returns its path, or None on failure.
+    Data is written to a '.part' file first, so an interrupted download is resumed
+    with a Range request on the next run instead of being mistaken for a finished file.
+    The '.part' file's ETag/Last-Modified is kept next to it and sent as If-Range, so a
+    file that changed on the server in the meantime is downloaded again from the start.
+    A file that is already complete is only fetched again if the server has a newer copy.
+    """
+    filename = link.split('/')[-1]
+    filepath = os.path.join(DOWNLOAD_DIR, filename)
+    part_path = filepath + '.part'
+    validator_path = part_path + '.validator'
+    headers = {}
+    if os.path.exists(filepath):
+        # Conditional GET: the server answers 304 without a body if the file is unchanged
+        headers['If-Modified-Since'] = email.utils.formatdate(os.path.getmtime(filepath), usegmt=True)
+    elif os.path.exists(part_path) and os.path.exists(validator_path):
+        with open(validator_path, encoding='utf-8') as f:
+            validator = f.read()
+        headers['Range'] = f"bytes={os.path.getsize(part_path)}-"
+        headers['If-Range'] = validator
+    else:
+        # Without a validator there is no way to tell if the partial data is still current
+        remove_partial_download(part_path)
+
+    print(f"Downloading {filename}...")
+    try:
+        response = http_retry(session.get)(link, headers=headers, stream=True)
+        if response.status_code == 304:
+            print(f"Skipping download, {filename} is up to date.")
+            return filepath
+        part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if response.status_code in (206, 416) and 'Range' not in headers:
+            print(f"Failed to fetch {link}. Unexpected status code: {response.status_code}")
+            return None
+        if response.status_code == 416:
+            # Only promote the partial file if it has exactly the remote size ('bytes */N')
+            content_range = response.headers.get('Content-Range', '')
+            total_size = content_range.rpartition('/')[2]
+            if total_size.isdigit() and int(total_size) == part_size:
+                os.replace(part_path, filepath)
+                remove_partial_download(part_path)
+                return filepath
+            print(f"  -> Partial download of {filename} does not match the remote file, starting over.")
+            remove_partial_download(part_path)
+            return download_file(session, link)
+
+        if response.status_code == 206:
+            # The server must resume exactly where the partial file ends
+            content_range = response.headers.get('Content-Range', '')
+            range_start = content_range.removeprefix('bytes ').partition('-')[0]
+            if not range_start.isdigit() or int(range_start) != part_size:
+                print(f"  -> Unexpected range for {filename}, starting over.")
+                remove_partial_download(part_path)
+                return download_file(session, link)
+            mode = 'ab'
+        elif response.status_code == 200:
+            # A new or updated file, the file changed since the partial download
+            # (If-Range did not match), or the server ignored the Range header
+            mode = 'wb'
+            validator = get_range_validator(response)
+            if validator:
+                with open(validator_path, 'w', encoding='utf-8') as f:
+                    f.write(validator)
+            elif os.path.exists(validator_path):
+                os.remove(validator_path)
+        else:
+            print(f"Failed to fetch {link}. Status code: {response.status_code}")
+            return None
+
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(part_path, filepath)
+        remove_partial_download(part_path)
+        return filepath
+    except hrequests.exceptions.ClientException as e:
+        print(f"  -> Failed to download {filename}: {e}")
+        return None
 
 def download_files(links):
-    """Downloads files from a list of URLs into the DOWNLOAD_DIR if they don't already exist."""
+    """Downloads files from a list of URLs into the DOWNLOAD_DIR if they are missing or outdated."""
     if not os.path.exists(DOWNLOAD_DIR):
         os.makedirs(DOWNLOAD_DIR)
         print(f"Created directory: {DOWNLOAD_DIR}")
 
-    downloaded_paths = []
-    for link in links:
-        filename = link.split('/')[-1]
-        filepath = os.path.join(DOWNLOAD_DIR, filename)
-        
-        if not os.path.exists(filepath):
-            print(f"Downloading {filename}...")
-            try:
-                response = hrequests.get(link, stream=True)
-                if response.status_code != 200:
-                    print(f"Failed to fetch {link}. Status code: {response.status_code}")
-                    return None
-                with open(filepath, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                downloaded_paths.append(filepath)
-            except hrequests.exceptions.ClientException as e:
-                print(f"  -> Failed to download {filename}: {e}")
-        else:
-            print(f"Skipping download, {filename} already exists.")
-            downloaded_paths.append(filepath)
-            
-    return downloaded_paths
+    # The files are on the same host, so a shared keep-alive session lets
+    # the parallel downloads reuse connections
+    session = hrequests.Session()
+    try:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            paths = list(executor.map(partial(download_file, session), links))
+    finally:
+        session.close()
+
+    return [path for path in paths if path]
 
 # --- STEP 2: PARSE EXCEL FILES & SAVE TO DB ---
 
@@ -146,7 +283,7 @@ def process_excel_file(filepath):
     and returns a single pandas DataFrame for that month.
     """
     filename = os.path.basename(filepath)
-    match = re.search(r'T01(\d{4})(\d{2})\.xlsx', filename)
+    match = FILENAME_DATE_PATTERN.search(filename)
     if not match:
         return None
         
@@ -155,13 +292,13 @@ def process_excel_file(filepath):
     print(f"Processing {filename} for date {date_str}...")
 
     try:
-        # Read all sheets from the Excel file into a dictionary of DataFrames
-        all_sheets = pd.read_excel(filepath, sheet_name=None, skiprows=7, engine='openpyxl')
+        # Calamine is a Rust XLSX reader; it returns plain rows of cell values
+        workbook = CalamineWorkbook.from_path(filepath)
     except Exception as e:
         print(f"  -> Could not read Excel file: {e}")
         return None
 
-    all_data = []
+    all_rows = []
     
     # Define the column mapping to standardize names
     column_mapping = {
@@ -171,65 +308,83 @@ def process_excel_file(filepath):
         'Relatív mutató** %': 'unemployment_rate'
     }
     
-    for sheet_name, df in all_sheets.items():
+    for sheet_name in workbook.sheet_names:
+        # Keep leading empty rows so that the header is always the 8th row
+        rows = workbook.get_sheet_by_name(sheet_name).to_python(skip_empty_area=False)
+        header = rows[7] if len(rows) > 7 else None
+
         # Check if the required columns exist by checking the first column name
-        if df.columns[0] in column_mapping:
-            
-            # Select and rename columns we care about
-            df = df.rename(columns=column_mapping)
-            df = df[list(column_mapping.values())]
-
-            # Drop rows with no town name (footers, empty rows)
-            df = df.dropna(subset=['town_name'])
-            
-            # Normalize town names (e.g., "ABALIGET" -> "Abaliget")
-            df['town_name'] = df['town_name'].str.strip().str.title()
-            
-            # Convert unemployment rate from '4,35' string to 4.35 float
-            df['unemployment_rate'] = df['unemployment_rate'].astype(str).str.replace(',', '.').astype(float)
-            
-            # Ensure other columns are numeric, coercing errors to NaN
-            for col in ['unemployed_total', 'working_age_population']:
-                 df[col] = pd.to_numeric(df[col], errors='coerce')
-
-            all_data.append(df)
-
-    if not all_data:
+        if header and header[0] in column_mapping and all(label in header for label in column_mapping):
+            # Only the four mapped columns are copied out of each row; the rest are never materialized
+            col_indices = [header.index(label) for label in column_mapping]
+            all_rows.extend([row[i] if i < len(row) else '' for i in col_indices] for row in rows[8:])
+
+    if not all_rows:
         print(f"  -> No valid data found in {filename}")
         return None
 
-    # Combine data from all sheets into one DataFrame
-    monthly_df = pd.concat(all_data, ignore_index=True)
+    # Rows from every sheet go into one DataFrame, so the cleanup below runs once
+    # per month and no per-sheet frames have to be concatenated.
+    # Calamine returns empty cells as '', treat them as missing values
+    monthly_df = pd.DataFrame(all_rows, columns=list(column_mapping.values())).replace('', np.nan)
+
+    # Drop rows with no town name (footers, empty rows)
+    monthly_df = monthly_df.dropna(subset=['town_name'])
+    
+    # Arrow-backed strings run the string operations below in C,
+    # instead of calling Python methods on every object
+    monthly_df = monthly_df.astype({'town_name': 'string[pyarrow]', 'unemployment_rate': 'string[pyarrow]'})
+
+    # Normalize town names (e.g., "ABALIGET" -> "Abaliget")
+    monthly_df['town_name'] = monthly_df['town_name'].str.strip().str.title()
+    
+    # Convert unemployment rate from '4,35' string to 4.35 float
+    monthly_df['unemployment_rate'] = monthly_df['unemployment_rate'].str.replace(',', '.').astype('float64')
+    
+    # Ensure other columns are numeric, coercing errors to NaN
+    count_cols = ['unemployed_total', 'working_age_population']
+    monthly_df[count_cols] = monthly_df[count_cols].apply(pd.to_numeric, errors='coerce')
     monthly_df['date'] = date_str
     
     print(f"  -> Successfully processed {len(monthly_df)} rows.")
     return monthly_df
 
 
-def save_to_db(df, date_str):
-    """Saves the monthly DataFrame to the SQLite database."""
-    if df is None or df.empty:
+def save_to_db(monthly_dfs):
+    """Saves all monthly DataFrames to the SQLite database in a single transaction."""
+    monthly_dfs = [df for df in monthly_dfs if df is not None and not df.empty]
+    if not monthly_dfs:
         return
 
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    columns = ['town_name', 'date', 'unemployed_total', 'working_age_population', 'unemployment_rate']
+    all_months_df = pd.concat(monthly_dfs, ignore_index=True)[columns]
+    dates = all_months_df['date'].unique().tolist()
 
-    # To ensure data integrity, delete any existing records for this month before inserting new ones.
-    # This makes the script safely re-runnable with updated Excel files.
-    cursor.execute(f"DELETE FROM {TABLE_NAME} WHERE date = ?", (date_str,))
-    
-    df.to_sql(TABLE_NAME, conn, if_exists='append', index=False)
+    # astype(object) turns NumPy numbers into Python ones, and missing values become NULL
+    all_months_df = all_months_df.astype(object).where(all_months_df.notna(), None)
+
+    conn = get_conn()
+    conn.execute("BEGIN")
+    try:
+        # To ensure data integrity, delete any existing records for these months before inserting new ones.
+        # This makes the script safely re-runnable with updated Excel files.
+        conn.executemany(f"DELETE FROM {TABLE_NAME} WHERE date = ?", [(date_str,) for date_str in dates])
+
+        conn.executemany(
+            f"INSERT INTO {TABLE_NAME} ({', '.join(columns)}) VALUES (?, ?, ?, ?, ?)",
+            all_months_df.itertuples(index=False, name=None)
+        )
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
     
-    print(f"Saved {len(df)} records for {date_str} to the database.")
-    conn.commit()
-    conn.close()
+    print(f"Saved {len(all_months_df)} records for {len(dates)} months to the database.")
 
 # --- MAIN EXECUTION ---
 
 def main():
     """Main function to run the entire scraping and processing pipeline."""
-    setup_database()
-    
     links = get_excel_links()
     if not links:
         print("No links found. Exiting.")
@@ -237,12 +392,16 @@ def main():
         
     filepaths = download_files(links)
     
-    for path in filepaths:
-        monthly_dataframe = process_excel_file(path)
-        if monthly_dataframe is not None:
-            # Get the date from the DataFrame to use for the delete operation
-            date_for_db = monthly_dataframe['date'].iloc[0]
-            save_to_db(monthly_dataframe, date_for_db)
+    # Parsing is CPU-bound, so every file gets its own worker process;
+    # the results are saved from this process only.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        monthly_dataframes = [df for df in executor.map(process_excel_file, filepaths) if df is not None]
+
+    # The database connection is only opened once the worker processes are
+    # done, so it is never inherited by a forked child.
+    setup_database()
+    save_to_db(monthly_dataframes)
+    close_conn()
 
     print("\nUnemployment data scraping and processing complete!")
 
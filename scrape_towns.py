@@ -1,16 +1,61 @@
+import asyncio
+import aiohttp
+import email.utils
 import hrequests
 from bs4 import BeautifulSoup
+import lxml.html
 import sqlite3
+import random
 import re
 import time
+from tenacity import retry, retry_if_exception_type, retry_if_result, stop_after_attempt, wait_exponential
 
 DATABASE_NAME = 'hungarian_towns.db'
 BASE_WIKI_URL = 'https://hu.wikipedia.org'
 TOWN_LIST_URL = 'https://hu.wikipedia.org/wiki/Magyarorsz%C3%A1g_telep%C3%BCl%C3%A9sei:_A,_%C3%81'
+INSERT_BATCH_SIZE = 100 # Scraped towns written per database transaction
+SCRAPE_CONCURRENCY = 3 # Town pages fetched concurrently (a few requests per second)
+# Wikimedia's User-Agent policy asks bots to identify themselves with a way to reach the operator;
+# generic library user agents can be rejected with 403
+HTTP_HEADERS = {'User-Agent': 'hollakyak-town-scraper/0.1 (https://github.com/PAndreew/hollakyak)'}
+HTTP_RETRY_ATTEMPTS = 5 # Tries per request before giving up on a page
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504} # Responses worth retrying
+MAX_RETRY_AFTER = 120 # Longest Retry-After (seconds) we are willing to wait for
+# Applied by get_conn() when the connection opens, since only journal_mode is persistent
+SQLITE_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+"""
+GEO_DEC_PATTERN = re.compile(r'(-?\d+\.?\d*)°[NS]\s*(-?\d+\.?\d*)°[EW]') # e.g. '47.0306°N 18.3444°E'
+DMS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(?:\D+(\d+(?:\.\d+)?))?(?:\D+(\d+(?:\.\d+)?))?') # Degrees, then optional minutes and seconds
+
+_CONN = None # Shared connection, see get_conn()
+
+def get_conn():
+    """
+    Returns the script's long-lived database connection, opening it with the
+    tuned pragmas on first use. It runs in autocommit mode, so writers wrap
+    their batches in explicit BEGIN/COMMIT.
+    """
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(DATABASE_NAME, isolation_level=None, check_same_thread=False)
+        _CONN.executescript(SQLITE_PRAGMAS)
+    return _CONN
+
+def close_conn():
+    """Closes the shared database connection, if it was opened."""
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
 
 def setup_database():
     """Sets up the SQLite database and table."""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = get_conn()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS towns (
@@ -26,14 +71,11 @@ def setup_database():
             longitude REAL
         )
     ''')
-    conn.commit()
-    conn.close()
 
 # --- NEW HELPER FUNCTION ---
 def get_completed_towns():
     """Queries the database and returns a set of names of towns that have already been scraped."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    cursor = get_conn().cursor()
     try:
         # We can just check for the name, since the name is the PRIMARY KEY.
         # Any entry means it has been processed.
@@ -43,36 +85,85 @@ def get_completed_towns():
     except sqlite3.Error as e:
         print(f"Database error while fetching completed towns: {e}")
         return set()
-    finally:
-        conn.close()
 
-def get_soup(url):
-    """Fetches a URL and returns a BeautifulSoup object."""
+def parse_retry_after(value):
+    """Converts a Retry-After header (seconds or an HTTP date) to seconds, or None if it can't be read."""
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def http_retry(retry_exceptions, get_status, get_headers):
+    """
+    Builds the retry policy shared by the hrequests and aiohttp fetches. Connection errors
+    (retry_exceptions) and 429/5xx statuses (read from the result with get_status) are
+    retried with exponential backoff, or after the server's Retry-After if that is longer.
+    After the last attempt its result is returned, or its error raised, as if there was no retrying.
+    """
+    backoff = wait_exponential(multiplier=0.5)
+
+    def wait(retry_state):
+        seconds = backoff(retry_state)
+        if not retry_state.outcome.failed:
+            retry_after = parse_retry_after(get_headers(retry_state.outcome.result()).get('Retry-After'))
+            if retry_after is not None:
+                seconds = max(seconds, min(retry_after, MAX_RETRY_AFTER))
+        return seconds
+
+    return retry(
+        stop=stop_after_attempt(HTTP_RETRY_ATTEMPTS),
+        wait=wait,
+        retry=retry_if_exception_type(retry_exceptions)
+        | retry_if_result(lambda result: get_status(result) in RETRY_STATUS_CODES),
+        retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+    )
+
+@http_retry(
+    hrequests.exceptions.ClientException,
+    lambda response: response.status_code,
+    lambda response: response.headers,
+)
+def session_get(session, url, **kwargs):
+    """GETs a URL over an hrequests session, retrying transient failures."""
+    return session.get(url, **kwargs)
+
+def get_tree(url, session):
+    """Fetches a URL over the shared keep-alive session and returns a parsed lxml HTML tree."""
     try:
         # Adding a timeout is good practice for network requests
-        response = hrequests.get(url, timeout=15)
+        response = session_get(session, url, headers=HTTP_HEADERS, timeout=15)
         if response.status_code != 200:
             print(f"Failed to fetch {url}. Status code: {response.status_code}")
             return None
-        return BeautifulSoup(response.text, 'html.parser')
+        return lxml.html.fromstring(response.text)
     except hrequests.exceptions.ClientException as e:
         print(f"Error fetching {url}: {e}")
         return None
 
-def scrape_town_list_page(soup):
+def get_element_text(element):
+    """Returns the element's text with each text node stripped, like BeautifulSoup's get_text(strip=True)."""
+    return ''.join(text.strip() for text in element.xpath('.//text()'))
+
+def scrape_town_list_page(tree):
     """
     Scrapes a single town list page for town details and links.
     This version is robust and handles tables with missing or reordered columns,
     and also tables where the <thead> tag is generated by JavaScript.
     """
     towns_data = []
-    table = soup.find('table', class_='wikitable sortable')
+    # lxml walks the tree in C, without wrapping every tag in a Python object like BeautifulSoup
+    tables = tree.xpath('//table[contains(concat(" ", @class, " "), " wikitable ") and contains(concat(" ", @class, " "), " sortable ")]')
 
-    if not table:
+    if not tables:
         print("Could not find the main town table on the page.")
         return towns_data
 
-    all_rows = table.find_all('tr')
+    all_rows = tables[0].xpath('.//tr')
     if not all_rows:
         print("Table has no rows. Skipping.")
         return towns_data
@@ -80,7 +171,7 @@ def scrape_town_list_page(soup):
     header_row = all_rows[0]
     data_rows = all_rows[1:]
 
-    headers = [th.get_text(strip=True) for th in header_row.find_all('th')]
+    headers = [get_element_text(th) for th in header_row.xpath('.//th')]
     
     header_map = {}
     key_mapping = {
@@ -101,20 +192,20 @@ def scrape_town_list_page(soup):
         return towns_data
     
     for row in data_rows:
-        cols = row.find_all('td')
+        cols = row.xpath('.//td')
         if not cols: continue
 
         def get_col_text(key):
             index = header_map.get(key)
-            return cols[index].get_text(strip=True) if index is not None and index < len(cols) else None
+            return get_element_text(cols[index]) if index is not None and index < len(cols) else None
 
         town_name_col_index = header_map.get('name')
         if town_name_col_index is None or town_name_col_index >= len(cols): continue
             
-        town_name_tag = cols[town_name_col_index].find('a')
-        if town_name_tag:
-            town_name = town_name_tag.get_text(strip=True)
-            town_link = town_name_tag['href']
+        town_name_tag = cols[town_name_col_index].find('.//a[@href]')
+        if town_name_tag is not None:
+            town_name = get_element_text(town_name_tag)
+            town_link = town_name_tag.get('href')
             population_str = get_col_text('population')
             zip_code_raw = get_col_text('zip_code')
 
@@ -131,15 +222,45 @@ def scrape_town_list_page(soup):
             })
     return towns_data
 
-def scrape_individual_town_page(town_url):
+@http_retry(
+    (aiohttp.ClientError, asyncio.TimeoutError),
+    lambda result: result[0],
+    lambda result: result[1],
+)
+async def fetch_text(session, url):
+    """Fetches a URL asynchronously, retrying transient failures. Returns (status, headers, text)."""
+    async with session.get(url) as response:
+        if response.status != 200:
+            return response.status, response.headers, None
+        return response.status, response.headers, await response.text()
+
+async def fetch_soup(session, url):
+    """Fetches a URL asynchronously and returns a BeautifulSoup object."""
+    try:
+        status, _, text = await fetch_text(session, url)
+        if status != 200:
+            print(f"Failed to fetch {url}. Status code: {status}")
+            return None
+        return BeautifulSoup(text, 'lxml')
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error fetching {url}: {e}")
+        return None
+
+async def scrape_individual_town_page(session, semaphore, town_url):
     """
     Scrapes an individual town page for mayor's name and GPS coordinates.
     Returns a tuple (mayor, latitude, longitude).
     """
-    soup = get_soup(town_url)
+    async with semaphore:
+        # A small random delay to be polite to Wikipedia's servers
+        await asyncio.sleep(random.uniform(0.2, 0.6))
+        soup = await fetch_soup(session, town_url)
     if not soup:
         return None, None, None
+    return parse_individual_town_page(soup, town_url)
 
+def parse_individual_town_page(soup, town_url):
+    """Extracts (mayor, latitude, longitude) from a town page's infobox."""
     mayor, latitude, longitude = None, None, None
     infobox = soup.find('table', class_='infobox ujinfobox')
     if infobox:
@@ -155,7 +276,7 @@ def scrape_individual_town_page(town_url):
                 try:
                     dec_coords = geo_span.find('span', class_='geo-dec')
                     if dec_coords:
-                        match = re.search(r'(-?\d+\.?\d*)°[NS]\s*(-?\d+\.?\d*)°[EW]', dec_coords.get_text())
+                        match = GEO_DEC_PATTERN.search(dec_coords.get_text())
                         if match:
                             latitude, longitude = float(match.group(1)), float(match.group(2))
                     
@@ -167,27 +288,26 @@ def scrape_individual_town_page(town_url):
     return mayor, latitude, longitude
 
 def convert_dms_to_decimal(dms_str):
-    """Converts a DMS string (e.g., 'é. sz. 47° 01′ 50″') to decimal degrees."""
-    clean_dms_str = re.sub(r'[é\. sz\.k\.h°′″]', '', dms_str)
-    parts = [float(p) for p in clean_dms_str.split() if p]
-    degrees = parts[0] if len(parts) > 0 else 0
-    minutes = parts[1] if len(parts) > 1 else 0
-    seconds = parts[2] if len(parts) > 2 else 0
-    decimal = degrees + minutes / 60 + seconds / 3600
-    if 'd.' in dms_str or 'ny.' in dms_str: decimal = -decimal
-    return decimal
-
-def insert_town_data(town_data):
-    """Inserts a single town's data into the database."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    try:
-        # Instead of using .values(), we explicitly list the values in the correct order.
-        # This ensures we only pass the 10 values that match the 10 columns.
-        cursor.execute('''
-            INSERT OR REPLACE INTO towns (name, type, county, kisterseg, jaras, population, zip_code, mayor, latitude, longitude)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+    """
+    Converts a DMS string (e.g., 'é. sz. 47° 01′ 50″') to decimal degrees.
+    Missing minute or second fields (e.g., 'é. sz. 47° 01′') count as zero.
+    """
+    match = DMS_PATTERN.search(dms_str)
+    if not match:
+        return 0.0
+    degrees, minutes, seconds = (float(part) if part else 0.0 for part in match.groups())
+    # Southern ('d.') and western ('ny.') coordinates are negative
+    sign = -1.0 if 'd.' in dms_str or 'ny.' in dms_str else 1.0
+    return sign * (degrees + minutes / 60 + seconds / 3600)
+
+def insert_towns_data(towns):
+    """Inserts a batch of towns into the database in a single transaction."""
+    if not towns:
+        return
+    # We explicitly list the values in the correct order.
+    # This ensures we only pass the 10 values that match the 10 columns.
+    rows = [
+        (
             town_data['name'],
             town_data['type'],
             town_data['county'],
@@ -198,12 +318,52 @@ def insert_town_data(town_data):
             town_data['mayor'],
             town_data['latitude'],
             town_data['longitude']
-        ))
-        conn.commit()
+        )
+        for town_data in towns
+    ]
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN")
+        conn.executemany('''
+            INSERT OR REPLACE INTO towns (name, type, county, kisterseg, jaras, population, zip_code, mayor, latitude, longitude)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.execute("COMMIT")
     except sqlite3.Error as e:
-        print(f"Error inserting data for {town_data['name']}: {e}")
-    finally:
-        conn.close()
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        print(f"Error inserting data for {len(rows)} towns: {e}")
+
+async def scrape_town_pages(towns):
+    """
+    Scrapes the individual pages of the given towns concurrently and saves them
+    in batches as they complete, so an interrupted run loses at most one batch.
+    """
+    semaphore = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit_per_host=SCRAPE_CONCURRENCY, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=15)
+
+    async def scrape_town(town):
+        return town, await scrape_individual_town_page(session, semaphore, town['link'])
+
+    pending_towns = []
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HTTP_HEADERS) as session:
+        tasks = [scrape_town(town) for town in towns]
+        for i, next_done in enumerate(asyncio.as_completed(tasks)):
+            town, (mayor, latitude, longitude) = await next_done
+            print(f"({i+1}/{len(towns)}) Processed {town['name']} from {town['link']}")
+            
+            # We need to update the original town dictionary before inserting
+            town['mayor'] = mayor
+            town['latitude'] = latitude
+            town['longitude'] = longitude
+            
+            pending_towns.append(town)
+            if len(pending_towns) >= INSERT_BATCH_SIZE:
+                insert_towns_data(pending_towns)
+                pending_towns = []
+
+    insert_towns_data(pending_towns)
 
 # --- REFACTORED MAIN FUNCTION ---
 def main():
@@ -213,53 +373,40 @@ def main():
     completed_towns = get_completed_towns()
     print(f"Found {len(completed_towns)} towns already in the database. Resuming...")
 
+    # One keep-alive session is shared by the list page requests, so connections are reused
+    session = hrequests.Session()
+
     # Step 2: Gather the full list of all towns from Wikipedia (this part is fast).
-    main_soup = get_soup(TOWN_LIST_URL)
-    if not main_soup:
+    main_tree = get_tree(TOWN_LIST_URL, session)
+    if main_tree is None:
         return
 
-    letter_links = []
-    toc_table = main_soup.find('table', id='toc')
-    if toc_table:
-        for a_tag in toc_table.find_all('a', href=True):
-            if a_tag['href'].startswith('/wiki/Magyarorsz%C3%A1g_telep%C3%BCl%C3%A9sei:'):
-                letter_links.append(BASE_WIKI_URL + a_tag['href'])
-    
-    if TOWN_LIST_URL not in letter_links:
-        letter_links.insert(0, TOWN_LIST_URL)
+    # A dict keeps the first-seen order and drops repeated links as they are found
+    letter_links = {TOWN_LIST_URL: None}
+    for href in main_tree.xpath('//table[@id="toc"]//a/@href'):
+        if href.startswith('/wiki/Magyarorsz%C3%A1g_telep%C3%BCl%C3%A9sei:'):
+            letter_links[BASE_WIKI_URL + href] = None
 
     all_towns = []
-    for link in sorted(list(set(letter_links))):
+    for link in letter_links:
         time.sleep(0.5)
         print(f"Gathering town list from: {link}")
-        list_soup = get_soup(link)
-        if list_soup:
-            towns_on_page = scrape_town_list_page(list_soup)
+        list_tree = get_tree(link, session)
+        if list_tree is not None:
+            towns_on_page = scrape_town_list_page(list_tree)
             all_towns.extend(towns_on_page)
 
+    session.close()
+
     print(f"Found a total of {len(all_towns)} towns. Now processing individual pages...")
 
-    # Step 3: Iterate through all towns and skip the ones already completed.
-    for i, town in enumerate(all_towns):
-        
-        # This is the core of the resume logic
-        if town['name'] in completed_towns:
-            # Optional: uncomment the line below for verbose skipping messages
-            # print(f"({i+1}/{len(all_towns)}) Skipping {town['name']}, already processed.")
-            continue
-        
-        # If not skipped, process the town as before
-        print(f"({i+1}/{len(all_towns)}) Processing {town['name']} from {town['link']}")
-        time.sleep(0.4) # A small delay to be polite to Wikipedia's servers
-        
-        mayor, latitude, longitude = scrape_individual_town_page(town['link'])
-        
-        # We need to update the original town dictionary before inserting
-        town['mayor'] = mayor
-        town['latitude'] = latitude
-        town['longitude'] = longitude
-        
-        insert_town_data(town)
+    # Step 3: Skip the towns already completed. This is the core of the resume logic.
+    towns_to_scrape = [town for town in all_towns if town['name'] not in completed_towns]
+    print(f"{len(all_towns) - len(towns_to_scrape)} towns already processed, {len(towns_to_scrape)} left.")
+
+    # Step 4: Scrape the remaining town pages concurrently.
+    asyncio.run(scrape_town_pages(towns_to_scrape))
+    close_conn()
     
     print("Scraping complete. Data stored in hungarian_towns.db")
 